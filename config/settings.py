@@ -1,4 +1,5 @@
 import os
+from typing import Final, Optional
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -9,6 +10,9 @@ class Settings:
     SIGNAL_GROUP_ID = os.getenv('SIGNAL_GROUP_ID')
     AFFILIATE_LINK = os.getenv('AFFILIATE_LINK')
     ADMIN_PHONE_NUMBER = os.getenv('ADMIN_PHONE_NUMBER')
+    # Optional UNIX socket of a `signal-cli -a NUMBER daemon --socket` instance;
+    # when unset a signal-cli jsonRpc child process is started instead
+    SIGNAL_CLI_SOCKET = os.getenv('SIGNAL_CLI_SOCKET')
     
     # Database Configuration
     DB_HOST = os.getenv('DB_HOST', 'localhost')
@@ -18,9 +22,17 @@ class Settings:
     
     # Database Pool Configuration
     DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
-    DB_POOL_MAX_OVERFLOW = int(os.getenv('DB_POOL_MAX_OVERFLOW', 5))
-    DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 30))
     DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 3600))
+    DB_CONNECTION_TIMEOUT = int(os.getenv('DB_CONNECTION_TIMEOUT', 10))
+    DB_PING_INTERVAL = int(os.getenv('DB_PING_INTERVAL', 60))
+    
+    # Cache Configuration
+    # Optional Redis for affiliate lookups and API key registration state (needs
+    # the redis package); when unset both are kept in process instead
+    REDIS_URL = os.getenv('REDIS_URL')
+    AFFILIATE_CACHE_TTL = int(os.getenv('AFFILIATE_CACHE_TTL', 3600))
+    # Seconds before an abandoned API key registration flow expires
+    REGISTRATION_TTL = int(os.getenv('REGISTRATION_TTL', 600))
     
     # Webhook Configuration
     WEBHOOK_URL = os.getenv('WEBHOOK_URL')
@@ -30,6 +42,8 @@ class Settings:
     
     # Application Settings
     POLL_INTERVAL_SECONDS = int(os.getenv('POLL_INTERVAL_SECONDS', 5))
+    ORDER_BATCH_SIZE = int(os.getenv('ORDER_BATCH_SIZE', 100))
+    ORDER_CONCURRENCY = int(os.getenv('ORDER_CONCURRENCY', 4))
     MAX_RETRIES = int(os.getenv('MAX_RETRIES', 3))
     LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
     TOKEN_LENGTH = int(os.getenv('TOKEN_LENGTH', 12))
@@ -55,3 +69,9 @@ class Settings:
             raise ValueError("WEBHOOK_URL is required when WEBHOOK_ENABLED is true")
 
 settings = Settings()
+
+# Values read on every loop iteration or order, bound at module level so hot
+# paths do a single global lookup instead of going through the settings object
+POLL_INTERVAL_SECONDS: Final[int] = settings.POLL_INTERVAL_SECONDS
+ORDER_BATCH_SIZE: Final[int] = settings.ORDER_BATCH_SIZE
+SIGNAL_GROUP_ID: Final[Optional[str]] = settings.SIGNAL_GROUP_ID
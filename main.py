@@ -8,18 +8,29 @@ import time
 import logging
 import signal
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from threading import Event
-from config.settings import settings
+from config.settings import settings, POLL_INTERVAL_SECONDS
 from services.signal_service import SignalService
 from services.database_service import DatabaseService
 from services.template_manager import TemplateManager
 from services.webhook_service import WebhookService
 from services.alert_service import AlertService
+from services.affiliate_repo import CachedAffiliateRepo
+from services.registration_store import RegistrationStore
 from services.message_handler import MessageHandler
-from utils.helpers import setup_logging
+from utils.helpers import setup_logging, create_redis_client
 
 logger = logging.getLogger(__name__)
 
+# A signal-cli stream that closes within this many seconds of starting counts as a failed
+# start (unregistered account, bad config, account lock held by another instance)
+STREAM_STABLE_SECONDS = 60
+# Failed starts are retried after 1, 2, 4... seconds, up to this delay
+STREAM_RESTART_MAX_DELAY = 300
+# Consecutive failed starts after which the admin is alerted
+STREAM_FAILURE_ALERT_THRESHOLD = 5
+
 class SignalAutomation:
     def __init__(self):
         self.shutdown_event = Event()
@@ -28,7 +39,13 @@ class SignalAutomation:
         self.template_manager = None
         self.webhook_service = None
         self.alert_service = None
+        self.redis_client = None
+        self.affiliate_repo = None
         self.message_handler = None
+        # signal-cli stream restart state, see _ensure_signal_stream
+        self.stream_started_at = float('-inf')
+        self.stream_retry_at = None
+        self.stream_failures = 0
         
     def initialize_services(self):
         """Initialize all services"""
@@ -42,17 +59,27 @@ class SignalAutomation:
             self.signal_service = SignalService()
             self.db_service = DatabaseService()
             self.template_manager = TemplateManager()
-            self.webhook_service = WebhookService()
+            # The webhook fallback is optional, only build it when it is enabled
+            if settings.WEBHOOK_ENABLED:
+                self.webhook_service = WebhookService()
             self.alert_service = AlertService(
                 self.signal_service, 
                 self.template_manager, 
                 self.webhook_service
             )
+            # Open the signal-cli stream; a Signal outage must not keep the service from
+            # starting, a failed start is retried by the main loop with backoff
+            self._ensure_signal_stream()
+            # Optional Redis shared by the affiliate cache and the registration state
+            self.redis_client = create_redis_client()
+            self.affiliate_repo = CachedAffiliateRepo(self.db_service, self.redis_client)
             self.message_handler = MessageHandler(
                 self.signal_service,
                 self.db_service,
                 self.template_manager,
-                self.alert_service
+                self.alert_service,
+                self.affiliate_repo,
+                RegistrationStore(self.redis_client)
             )
             
             # Test connectivity
@@ -69,17 +96,23 @@ class SignalAutomation:
         """Test system connectivity on startup"""
         logger.info("Testing system connectivity...")
         
-        # Test database
-        if not self.db_service.test_connection():
-            raise Exception("Database connectivity test failed")
-        
-        # Test Signal CLI
-        if not self.signal_service.test_signal_cli():
-            logger.warning("Signal CLI test failed - service may have issues")
-        
-        # Test alert systems
-        alert_results = self.alert_service.test_alert_systems()
-        logger.info(f"Alert system tests: {alert_results}")
+        # The probes are independent and mostly waiting on I/O, run them concurrently
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            database_test = executor.submit(self.db_service.test_connection)
+            signal_test = executor.submit(self.signal_service.test_signal_cli)
+            alert_test = executor.submit(self.alert_service.test_alert_systems)
+            
+            # Test database
+            if not database_test.result():
+                raise Exception("Database connectivity test failed")
+            
+            # Test Signal CLI
+            if not signal_test.result():
+                logger.warning("Signal CLI test failed - service may have issues")
+            
+            # Test alert systems
+            alert_results = alert_test.result()
+            logger.info(f"Alert system tests: {alert_results}")
         
         logger.info("System connectivity tests completed")
     
@@ -88,26 +121,38 @@ class SignalAutomation:
         def signal_handler(signum, frame):
             logger.info(f"Received signal {signum}, initiating shutdown...")
             self.shutdown_event.set()
+            # The main loop may be blocked waiting for messages
+            if self.signal_service:
+                self.signal_service.wake()
         
         signal.signal(signal.SIGTERM, signal_handler)
         signal.signal(signal.SIGINT, signal_handler)
     
     def run_main_loop(self):
-        """Main application loop"""
+        """Main application loop, woken by incoming Signal messages or the order ticker"""
         logger.info("Starting main application loop...")
         
+        next_order_check = 0.0
+        
         while not self.shutdown_event.is_set():
             try:
-                # Process received messages
-                messages = self.signal_service.receive_messages()
-                if messages:
-                    self.message_handler.process_received_messages(messages)
+                # (Re)start the signal-cli stream, its reader thread queues incoming messages
+                self._ensure_signal_stream()
                 
-                # Process new orders
-                self.message_handler.process_new_orders()
+                # Process new orders; re-check right away while a backlog drains,
+                # fall back to the regular interval once the queue is empty
+                now = time.monotonic()
+                if now >= next_order_check:
+                    notified = self.message_handler.process_new_orders()
+                    next_order_check = now if notified else now + POLL_INTERVAL_SECONDS
                 
-                # Wait before next iteration
-                self.shutdown_event.wait(settings.POLL_INTERVAL_SECONDS)
+                # Block until a message arrives, a signal is received or the next order check is due
+                timeout = max(0.0, next_order_check - time.monotonic())
+                if self.stream_retry_at is not None:
+                    timeout = min(timeout, max(0.0, self.stream_retry_at - time.monotonic()))
+                messages = self.signal_service.receive_messages(timeout)
+                if messages:
+                    self.message_handler.process_received_messages(messages)
                 
             except KeyboardInterrupt:
                 logger.info("Keyboard interrupt received")
@@ -118,13 +163,69 @@ class SignalAutomation:
                 # Wait a bit before retrying to avoid tight error loops
                 self.shutdown_event.wait(5)
     
+    def _ensure_signal_stream(self):
+        """Reopen the signal-cli stream once it closed, backing off exponentially while it
+        keeps closing right after starting"""
+        now = time.monotonic()
+        if self.signal_service.is_receiving():
+            if self.stream_retry_at is not None:
+                # A send reopened the stream in the meantime
+                self.stream_started_at = now
+                self.stream_retry_at = None
+            return
+        
+        if self.stream_retry_at is None:
+            if now - self.stream_started_at >= STREAM_STABLE_SECONDS:
+                # First start, or the stream ran for a while: open it right away
+                self.stream_failures = 0
+                self.stream_retry_at = now
+            else:
+                self._signal_stream_failed(now)
+        
+        if now < self.stream_retry_at:
+            return
+        
+        try:
+            self.signal_service.start_receiving()
+        except Exception as e:
+            logger.error(f"Failed to start signal-cli stream: {e}")
+            self._signal_stream_failed(now)
+            return
+        
+        self.stream_started_at = now
+        self.stream_retry_at = None
+    
+    def _signal_stream_failed(self, now: float):
+        """Schedule the next signal-cli stream start and alert once failures keep repeating"""
+        self.stream_failures += 1
+        delay = min(STREAM_RESTART_MAX_DELAY, 2 ** (self.stream_failures - 1))
+        self.stream_retry_at = now + delay
+        logger.warning(
+            f"signal-cli stream failed {self.stream_failures} time(s) in a row, restarting in {delay} seconds"
+        )
+        
+        if self.stream_failures == STREAM_FAILURE_ALERT_THRESHOLD:
+            # Signal itself is down, alert_signal_error goes through the webhook and the critical log
+            self.alert_service.alert_signal_error(
+                f"signal-cli stream failed {self.stream_failures} times in a row, still retrying"
+            )
+    
     def cleanup(self):
         """Cleanup resources"""
         logger.info("Cleaning up resources...")
         
         try:
-            if self.template_manager:
-                self.template_manager.stop_watching()
+            if self.message_handler:
+                self.message_handler.close()
+            
+            if self.signal_service:
+                self.signal_service.stop_receiving()
+            
+            if self.redis_client:
+                self.redis_client.close()
+            
+            if self.webhook_service:
+                self.webhook_service.close()
             
             if self.db_service:
                 self.db_service.close_pool()
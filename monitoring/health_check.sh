@@ -9,6 +9,7 @@ CRITICAL_LOG="/opt/signal-automation/logs/critical-errors.log"
 ADMIN_PHONE="+33987654321"  # Update with actual admin phone
 SIGNAL_NUMBER="+33123456789"  # Update with actual signal number
 SERVICE_USER="signal-automation"
+SIGNAL_CLI_SOCKET=""  # Same as the service's SIGNAL_CLI_SOCKET when signal-cli runs as a daemon
 
 # Function to log messages
 log_message() {
@@ -20,9 +21,26 @@ send_emergency_alert() {
     local message="$1"
     log_message "EMERGENCY: $message"
     
-    # Try to send via signal-cli directly as service user
-    if command -v signal-cli >/dev/null 2>&1; then
-        sudo -u "$SERVICE_USER" signal-cli -a "$SIGNAL_NUMBER" send "$ADMIN_PHONE" -m "🚨 HEALTH CHECK ALERT: $message" 2>/dev/null
+    # The running service keeps signal-cli open and holds the account lock, a direct
+    # signal-cli call would wait on it forever. Send through the daemon socket instead
+    if [ -n "$SIGNAL_CLI_SOCKET" ] && [ -S "$SIGNAL_CLI_SOCKET" ]; then
+        sudo -u "$SERVICE_USER" timeout 60 python3 - "$SIGNAL_CLI_SOCKET" "$ADMIN_PHONE" "🚨 HEALTH CHECK ALERT: $message" <<'PYEOF' 2>/dev/null
+import json, socket, sys
+path, recipient, message = sys.argv[1:]
+request = {"jsonrpc": "2.0", "method": "send", "params": {"recipient": [recipient], "message": message}, "id": 1}
+with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+    connection.connect(path)
+    connection.sendall(json.dumps(request).encode() + b"\n")
+    # The daemon also streams incoming messages to its clients, wait for our response
+    for line in connection.makefile("rb"):
+        if json.loads(line).get("id") == 1:
+            break
+PYEOF
+    # Without a socket signal-cli can only be used directly while the service is stopped
+    elif ! check_service_status && command -v signal-cli >/dev/null 2>&1; then
+        sudo -u "$SERVICE_USER" timeout 60 signal-cli -a "$SIGNAL_NUMBER" send "$ADMIN_PHONE" -m "🚨 HEALTH CHECK ALERT: $message" 2>/dev/null
+    else
+        log_message "Signal alert not sent: the service holds the signal-cli account and SIGNAL_CLI_SOCKET is not set"
     fi
     
     # You can add additional alert methods here (email, webhook, etc.)
@@ -0,0 +1,89 @@
+import json
+import logging
+from dataclasses import asdict
+from datetime import datetime
+from typing import Callable, Optional
+from cachetools import TTLCache
+from services.database_service import DatabaseService
+from models.affiliate import Affiliate
+from config.settings import settings
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+class CachedAffiliateRepo:
+    """Affiliate lookups fronted by Redis when a client is given, by an in-process cache otherwise"""
+    
+    def __init__(self, db_service: DatabaseService, redis_client: Optional['redis.Redis'] = None):
+        self.db_service = db_service
+        self.ttl = settings.AFFILIATE_CACHE_TTL
+        self.redis = redis_client
+        self.local_cache = None
+        
+        if self.redis is None:
+            self.local_cache = TTLCache(maxsize=4096, ttl=self.ttl)  # {key: Affiliate}
+    
+    def get_by_phone(self, phone_number: str) -> Optional[Affiliate]:
+        """Get affiliate by phone number"""
+        return self._get(f"affiliate:phone:{phone_number}",
+                         lambda: self.db_service.get_affiliate_by_phone(phone_number))
+    
+    def invalidate(self, phone_number: str):
+        """Drop the cached lookup of an affiliate after it was created or changed"""
+        key = f"affiliate:phone:{phone_number}"
+        
+        if self.redis is None:
+            self.local_cache.pop(key, None)
+            return
+        
+        try:
+            self.redis.delete(key)
+        except redis.RedisError as e:
+            logger.warning(f"Failed to invalidate cached affiliate {phone_number}: {e}")
+    
+    def _get(self, key: str, load: Callable[[], Optional[Affiliate]]) -> Optional[Affiliate]:
+        """Serve a lookup from the cache, loading it from the database on a miss"""
+        if self.redis is None:
+            affiliate = self.local_cache.get(key)
+            if affiliate is None:
+                affiliate = load()
+                # Only cache hits, a miss becomes stale as soon as the affiliate registers
+                if affiliate:
+                    self.local_cache[key] = affiliate
+            return affiliate
+        
+        # Redis is only a shortcut, when it is unavailable fall back to the database
+        try:
+            cached = self.redis.get(key)
+            if cached is not None:
+                return self._loads(cached)
+        except redis.RedisError as e:
+            logger.warning(f"Affiliate cache lookup failed for {key}: {e}")
+        
+        affiliate = load()
+        if affiliate:
+            try:
+                self.redis.setex(key, self.ttl, self._dumps(affiliate))
+            except redis.RedisError as e:
+                logger.warning(f"Failed to cache affiliate for {key}: {e}")
+        return affiliate
+    
+    @staticmethod
+    def _dumps(affiliate: Affiliate) -> str:
+        """Serialize an affiliate for Redis"""
+        data = asdict(affiliate)
+        if affiliate.created_at:
+            data['created_at'] = affiliate.created_at.isoformat()
+        return json.dumps(data)
+    
+    @staticmethod
+    def _loads(raw: bytes) -> Affiliate:
+        """Rebuild an affiliate serialized by _dumps"""
+        data = json.loads(raw)
+        if data['created_at']:
+            data['created_at'] = datetime.fromisoformat(data['created_at'])
+        return Affiliate(**data)
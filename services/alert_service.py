@@ -1,5 +1,5 @@
 import logging
-from typing import Dict
+from typing import Dict, Optional
 from services.signal_service import SignalService
 from services.template_manager import TemplateManager
 from services.webhook_service import WebhookService
@@ -7,7 +7,8 @@ from services.webhook_service import WebhookService
 logger = logging.getLogger(__name__)
 
 class AlertService:
-    def __init__(self, signal_service: SignalService, template_manager: TemplateManager, webhook_service: WebhookService):
+    def __init__(self, signal_service: SignalService, template_manager: TemplateManager,
+                 webhook_service: Optional[WebhookService] = None):
         self.signal_service = signal_service
         self.template_manager = template_manager
         self.webhook_service = webhook_service
@@ -24,13 +25,15 @@ class AlertService:
                 self.critical_logger.error(f"Failed to send Signal alert: {message}")
                 
                 # Fallback to webhook if Signal fails
-                webhook_message = self.template_manager.format_message('webhook_alert', message=message)
-                webhook_success = self.webhook_service.send_webhook(webhook_message, alert_type)
+                webhook_success = False
+                if self.webhook_service:
+                    webhook_message = self.template_manager.format_message('webhook_alert', message=message)
+                    webhook_success = self.webhook_service.send_webhook(webhook_message, alert_type)
                 
                 if not webhook_success:
                     self.critical_logger.error(f"Both Signal and webhook alerts failed: {message}")
                 else:
-                    logger.info(f"Webhook fallback successful for: {message}")
+                    logger.info("Webhook fallback successful for: %s", message)
             
         except Exception as e:
             self.critical_logger.error(f"Alert service error: {e} - Original message: {message}")
@@ -43,8 +46,9 @@ class AlertService:
         """Alert about Signal service issues"""
         self.critical_logger.error(f"Signal service error: {error_message}")
         # Use webhook for Signal errors since Signal is down
-        webhook_message = self.template_manager.format_message('webhook_alert', message=f"Signal error: {error_message}")
-        self.webhook_service.send_webhook(webhook_message, "error")
+        if self.webhook_service:
+            webhook_message = self.template_manager.format_message('webhook_alert', message=f"Signal error: {error_message}")
+            self.webhook_service.send_webhook(webhook_message, "error")
     
     def alert_critical_error(self, error_message: str):
         """Alert about critical system errors"""
@@ -59,6 +63,10 @@ class AlertService:
         results['signal'] = self.signal_service.test_signal_cli()
         
         # Test Webhook
-        results['webhook'] = self.webhook_service.test_webhook()
+        if self.webhook_service:
+            results['webhook'] = self.webhook_service.test_webhook()
+        else:
+            logger.info("Webhook is disabled")
+            results['webhook'] = True
         
         return results
@@ -1,58 +1,251 @@
 import mysql.connector
 from mysql.connector import pooling, Error
 import logging
+import threading
+import time
+from cachetools import LRUCache
 from typing import List, Optional, Dict
 from config.settings import settings
 from models.affiliate import Affiliate
 from models.order import Order
 from typing import List, Optional, Dict, Tuple
+from dataclasses import fields
+from contextlib import contextmanager
 
 logger = logging.getLogger(__name__)
 
+def _columns(model, alias: str = '') -> str:
+    """Select list in dataclass field order, so rows can be passed positionally to the model"""
+    prefix = f"{alias}." if alias else ''
+    return ', '.join(prefix + field.name for field in fields(model))
+
+AFFILIATE_COLUMNS = _columns(Affiliate)
+ORDER_WITH_AFFILIATE_COLUMNS = f"{_columns(Order, 'o')}, {_columns(Affiliate, 'a')}"
+ORDER_FIELD_COUNT = len(fields(Order))
+
+# Hot statements, run through server-side prepared statements
+AFFILIATE_BY_PHONE_QUERY = f"SELECT {AFFILIATE_COLUMNS} FROM affiliates WHERE phone_number = %s AND is_active = TRUE"
+CLAIM_ORDERS_QUERY = f"""
+    SELECT {ORDER_WITH_AFFILIATE_COLUMNS}
+    FROM orders o
+    LEFT JOIN affiliates a ON a.token = o.affiliate_token AND a.is_active = TRUE
+    WHERE o.notified = FALSE
+    ORDER BY o.created_at ASC
+    LIMIT %s
+    FOR UPDATE OF o SKIP LOCKED
+"""
+
+class _StatementCache(LRUCache):
+    """LRU of prepared cursors keyed by (server connection id, query). An evicted cursor
+    may belong to a connection another thread is using, so instead of being closed right
+    away it is parked until a statement next runs on its connection, see take_evicted"""
+    
+    def __init__(self, maxsize: int):
+        super().__init__(maxsize)
+        # Bounded too: cursors of a connection that never comes back are simply dropped
+        self.evicted = LRUCache(maxsize)  # {connection id: [cursor]}
+    
+    def popitem(self):
+        key, cursor = super().popitem()
+        self.evicted.setdefault(key[0], []).append(cursor)
+        return key, cursor
+    
+    def take_evicted(self, connection_id: int) -> List:
+        """Remove and return the evicted cursors of a connection, for its user to close"""
+        return self.evicted.pop(connection_id, [])
+
 class DatabaseService:
     def __init__(self):
         self.pool = None
+        self.connection_config = None
+        # Dedicated per-thread connection for the hot queries, so the main loop
+        # skips the pool checkout and its liveness ping on every call
+        self.local = threading.local()
+        # Every thread's dedicated connection, so close_pool can close them all. Held
+        # strongly: the order workers have exited by then, dropping their thread-locals
+        self.worker_connections = set()
+        self.worker_connections_lock = threading.Lock()
+        # Prepared cursors keyed by (server connection id, query); a reconnect gets a
+        # new id, so statements of a dropped session are never reused
+        self.statements = _StatementCache(maxsize=settings.DB_POOL_SIZE * 8)
+        self.statements_lock = threading.Lock()
         self.create_pool()
     
     def create_pool(self):
         """Create database connection pool"""
         try:
-            pool_config = {
-            'pool_name': 'signal_automation_pool',
-            'pool_size': settings.DB_POOL_SIZE,
-            'pool_reset_session': True,
+            self.connection_config = {
             'host': settings.DB_HOST,
             'database': settings.DB_NAME,
             'user': settings.DB_USER,
             'password': settings.DB_PASSWORD,
-            'autocommit': settings.DB_AUTOCOMMIT,
+            # Single statements commit on their own; multi-statement work opens an
+            # explicit transaction through _connection(transaction=True)
+            'autocommit': True,
             'connection_timeout': settings.DB_CONNECTION_TIMEOUT,
+            # Use the C extension for protocol handling and row parsing
+            'use_pure': False,
+            # The driver converts rows itself: DECIMAL to Decimal and TIMESTAMP to
+            # datetime, which is what the models expect without further conversion
+            'raw': False,
+            # TIMESTAMP columns come back in the session time zone; pin it to UTC so
+            # naive values are UTC and take a single conversion to the local zone
+            'time_zone': '+00:00',
+            }
+            
+            pool_config = {
+            'pool_name': 'signal_automation_pool',
+            'pool_size': settings.DB_POOL_SIZE,
+            # Resetting the session on checkout would deallocate the cached prepared
+            # statements; queries do not depend on any other session state
+            'pool_reset_session': False,
+            **self.connection_config,
             }
             
             self.pool = pooling.MySQLConnectionPool(**pool_config)
             logger.info(f"Database connection pool created with {settings.DB_POOL_SIZE} connections")
             
+            if not mysql.connector.HAVE_CEXT:
+                logger.warning("MySQL C extension not available, falling back to pure Python driver")
+            
         except Error as e:
             logger.error(f"Database pool creation failed: {e}")
             raise
     
     def get_connection(self):
-        """Get connection from pool"""
+        """Get connection from pool, reconnecting it first if the server dropped it"""
+        connection = None
         try:
-            return self.pool.get_connection()
+            connection = self.pool.get_connection()
+            # Pooled sockets go stale after the server's wait_timeout; check and
+            # transparently reconnect before handing the connection out
+            connection.ping(reconnect=True, attempts=3, delay=0)
+            return connection
         except Error as e:
             logger.error(f"Failed to get connection from pool: {e}")
+            if connection:
+                connection.close()
             raise
     
-    def test_connection(self) -> bool:
-        """Test database connectivity"""
-        try:
+    def _worker_connection(self):
+        """Get the calling thread's dedicated connection, opening it on first use.
+        It is only pinged after sitting idle, instead of on every checkout."""
+        connection = getattr(self.local, 'connection', None)
+        now = time.monotonic()
+        
+        if connection is None:
+            connection = mysql.connector.connect(**self.connection_config)
+            self.local.connection = connection
+            with self.worker_connections_lock:
+                self.worker_connections.add(connection)
+        elif now - self.local.last_used > settings.DB_PING_INTERVAL:
+            connection.ping(reconnect=True, attempts=3, delay=0)
+        
+        self.local.last_used = now
+        return connection
+    
+    def _drop_worker_connection(self):
+        """Close the calling thread's dedicated connection, the next use reopens it"""
+        connection = getattr(self.local, 'connection', None)
+        self.local.connection = None
+        if connection:
+            with self.worker_connections_lock:
+                self.worker_connections.discard(connection)
+            try:
+                connection.close()
+            except Error:
+                pass
+    
+    @contextmanager
+    def _connection(self, transaction: bool = False, worker: bool = False):
+        """Check out a connection and yield it.
+        With worker set, the thread's dedicated connection is used, falling back to
+        the pool if it cannot be opened. With transaction set, the work runs in an
+        explicit READ COMMITTED transaction committed on success. Anything left
+        open is rolled back and pooled connections are always returned."""
+        connection = None
+        if worker:
+            try:
+                connection = self._worker_connection()
+            except Error as e:
+                logger.warning(f"Worker connection unavailable, using the pool: {e}")
+                self._drop_worker_connection()
+        pooled = connection is None
+        if pooled:
             connection = self.get_connection()
+        
+        failed = True
+        try:
+            if transaction:
+                connection.start_transaction(isolation_level='READ COMMITTED')
+            yield connection
+            if transaction:
+                connection.commit()
+            failed = False
+        finally:
+            try:
+                # Sessions are not reset on checkout, so never hand a failed
+                # transaction over to the next user of the connection
+                if connection.in_transaction:
+                    connection.rollback()
+            except Error as e:
+                logger.warning(f"Rollback before releasing connection failed: {e}")
+                failed = True
+            finally:
+                if pooled:
+                    connection.close()
+                elif failed:
+                    # The dedicated connection may be broken, reopen it on next use
+                    self._drop_worker_connection()
+    
+    @contextmanager
+    def _cursor(self, transaction: bool = False, worker: bool = False):
+        """Check out a connection and yield (connection, cursor), see _connection"""
+        with self._connection(transaction, worker) as connection:
             cursor = connection.cursor()
-            cursor.execute("SELECT 1")
-            result = cursor.fetchone()
+            try:
+                yield connection, cursor
+            finally:
+                cursor.close()
+    
+    def _execute_prepared(self, connection, query: str, params: tuple):
+        """Execute query through a prepared cursor reused across checkouts of the same
+        server connection, so the statement is only parsed once per connection"""
+        key = (connection.connection_id, query)
+        with self.statements_lock:
+            evicted = self.statements.take_evicted(key[0])
+            cursor = self.statements.get(key)
+            if cursor is None:
+                cursor = connection.cursor(prepared=True)
+                self.statements[key] = cursor
+        
+        # The caller holds the connection, so its evicted statements can be deallocated now
+        for evicted_cursor in evicted:
+            self._close_prepared(evicted_cursor)
+        
+        try:
+            cursor.execute(query, params)
+        except Error:
+            with self.statements_lock:
+                self.statements.pop(key, None)
+            self._close_prepared(cursor)
+            raise
+        return cursor
+    
+    @staticmethod
+    def _close_prepared(cursor):
+        """Close a prepared cursor, deallocating its statement on the server"""
+        try:
             cursor.close()
-            connection.close()
+        except Error as e:
+            logger.warning(f"Failed to close prepared statement: {e}")
+    
+    def test_connection(self) -> bool:
+        """Test database connectivity"""
+        try:
+            with self._cursor() as (_, cursor):
+                cursor.execute("SELECT 1")
+                result = cursor.fetchone()
             return result[0] == 1
         except Exception as e:
             logger.error(f"Database connection test failed: {e}")
@@ -60,208 +253,140 @@ class DatabaseService:
     
     def create_affiliate(self, phone_number: str, token: str) -> Optional[int]:
         """Create new affiliate"""
-        connection = None
         try:
-            connection = self.get_connection()
-            cursor = connection.cursor()
-            
-            query = "INSERT INTO affiliates (phone_number, token) VALUES (%s, %s)"
-            cursor.execute(query, (phone_number, token))
-            
-            affiliate_id = cursor.lastrowid
-            connection.commit()
-            cursor.close()
+            with self._cursor() as (_, cursor):
+                query = "INSERT INTO affiliates (phone_number, token) VALUES (%s, %s)"
+                cursor.execute(query, (phone_number, token))
+                affiliate_id = cursor.lastrowid
             
-            logger.info(f"Created affiliate: {phone_number} with token: {token}")
+            logger.info("Created affiliate: %s with token: %s", phone_number, token)
             return affiliate_id
             
         except mysql.connector.IntegrityError as e:
             logger.warning(f"Affiliate already exists: {phone_number}")
-            if connection:
-                connection.rollback()
             return None
         except Error as e:
             logger.error(f"Error creating affiliate: {e}")
-            if connection:
-                connection.rollback()
             return None
-        finally:
-            if connection:
-                connection.close()
     
     def get_affiliate_by_phone(self, phone_number: str) -> Optional[Affiliate]:
         """Get affiliate by phone number"""
-        connection = None
         try:
-            connection = self.get_connection()
-            cursor = connection.cursor(dictionary=True)
+            with self._connection(worker=True) as connection:
+                cursor = self._execute_prepared(connection, AFFILIATE_BY_PHONE_QUERY, (phone_number,))
+                results = cursor.fetchall()
             
-            query = "SELECT * FROM affiliates WHERE phone_number = %s AND is_active = TRUE"
-            cursor.execute(query, (phone_number,))
-            
-            result = cursor.fetchone()
-            cursor.close()
-            
-            if result:
-                return Affiliate(**result)
+            if results:
+                return Affiliate(*results[0])
             return None
             
         except Error as e:
             logger.error(f"Error getting affiliate by phone: {e}")
             return None
-        finally:
-            if connection:
-                connection.close()
     
-    def get_affiliate_by_token(self, token: str) -> Optional[Affiliate]:
-        """Get affiliate by token"""
-        connection = None
+    def claim_orders_for_notification(self, batch_size: int) -> List[Tuple[Order, Optional[Affiliate]]]:
+        """Claim a batch of unnotified orders, joined with their active affiliate.
+        Rows are locked with SKIP LOCKED (MySQL 8.0+) and flagged as notified in the
+        same transaction, so concurrent workers never claim the same order."""
         try:
-            connection = self.get_connection()
-            cursor = connection.cursor(dictionary=True)
-            
-            query = "SELECT * FROM affiliates WHERE token = %s AND is_active = TRUE"
-            cursor.execute(query, (token,))
-            
-            result = cursor.fetchone()
-            cursor.close()
-            
-            if result:
-                return Affiliate(**result)
-            return None
-            
-        except Error as e:
-            logger.error(f"Error getting affiliate by token: {e}")
-            return None
-        finally:
-            if connection:
-                connection.close()
-    
-    def get_unnotified_orders(self) -> List[Order]:
-        """Get orders that haven't been notified"""
-        connection = None
-        try:
-            connection = self.get_connection()
-            cursor = connection.cursor(dictionary=True)
-            
-            query = "SELECT * FROM orders WHERE notified = FALSE ORDER BY created_at ASC"
-            cursor.execute(query)
-            
-            results = cursor.fetchall()
-            cursor.close()
-            
-            return [Order(**row) for row in results]
+            with self._connection(transaction=True, worker=True) as connection:
+                cursor = self._execute_prepared(connection, CLAIM_ORDERS_QUERY, (batch_size,))
+                results = cursor.fetchall()
+                
+                if results:
+                    update_cursor = connection.cursor()
+                    try:
+                        self._set_orders_notified(update_cursor, [row[0] for row in results], True)
+                    finally:
+                        update_cursor.close()
+            
+            split = ORDER_FIELD_COUNT
+            return [
+                (Order(*row[:split]), Affiliate(*row[split:]) if row[split] is not None else None)
+                for row in results
+            ]
             
         except Error as e:
-            logger.error(f"Error getting unnotified orders: {e}")
+            logger.error(f"Error claiming unnotified orders: {e}")
             return []
-        finally:
-            if connection:
-                connection.close()
     
-    def mark_order_as_notified(self, order_id: int) -> bool:
-        """Mark order as notified"""
-        connection = None
+    def release_orders(self, order_ids: List[int]) -> bool:
+        """Hand claimed orders back as unnotified so they are picked up again"""
+        if not order_ids:
+            return True
+        
         try:
-            connection = self.get_connection()
-            cursor = connection.cursor()
-            
-            query = "UPDATE orders SET notified = TRUE WHERE id = %s"
-            cursor.execute(query, (order_id,))
+            with self._cursor(worker=True) as (_, cursor):
+                self._set_orders_notified(cursor, order_ids, False)
             
-            connection.commit()
-            cursor.close()
-            
-            logger.info(f"Marked order {order_id} as notified")
+            logger.info("Released %s orders for another notification attempt", len(order_ids))
             return True
             
         except Error as e:
-            logger.error(f"Error marking order as notified: {e}")
-            if connection:
-                connection.rollback()
+            logger.error(f"Error releasing orders: {e}")
             return False
-        finally:
-            if connection:
-                connection.close()
+    
+    def _set_orders_notified(self, cursor, order_ids: List[int], notified: bool):
+        """Set the notified flag of a batch of orders in a single statement"""
+        placeholders = ', '.join(['%s'] * len(order_ids))
+        query = f"UPDATE orders SET notified = %s WHERE id IN ({placeholders})"
+        cursor.execute(query, (notified, *order_ids))
     
     def save_api_key(self, key: str) -> Optional[int]:
         """Save API key and return ID"""
-        connection = None
         try:
-            connection = self.get_connection()
-            cursor = connection.cursor()
-            
-            query = "INSERT INTO api_keys (`key`) VALUES (%s)"
-            cursor.execute(query, (key,))
+            with self._cursor() as (_, cursor):
+                query = "INSERT INTO api_keys (`key`) VALUES (%s)"
+                cursor.execute(query, (key,))
+                api_key_id = cursor.lastrowid
             
-            api_key_id = cursor.lastrowid
-            connection.commit()
-            cursor.close()
-            
-            logger.info(f"Saved API key with ID: {api_key_id}")
+            logger.info("Saved API key with ID: %s", api_key_id)
             return api_key_id
             
         except Error as e:
             logger.error(f"Error saving API key: {e}")
-            if connection:
-                connection.rollback()
             return None
-        finally:
-            if connection:
-                connection.close()
     
     def save_merchant_code(self, api_key_id: int, merchant_code: str) -> bool:
         """Save merchant code for API key"""
-        connection = None
         try:
-            connection = self.get_connection()
-            cursor = connection.cursor()
-            
-            query = "UPDATE api_keys SET merchant_code = %s WHERE id = %s"
-            cursor.execute(query, (merchant_code, api_key_id))
-            
-            connection.commit()
-            cursor.close()
+            with self._cursor() as (_, cursor):
+                query = "UPDATE api_keys SET merchant_code = %s WHERE id = %s"
+                cursor.execute(query, (merchant_code, api_key_id))
             
-            logger.info(f"Saved merchant code for API key ID: {api_key_id}")
+            logger.info("Saved merchant code for API key ID: %s", api_key_id)
             return True
             
         except Error as e:
             logger.error(f"Error saving merchant code: {e}")
-            if connection:
-                connection.rollback()
             return False
-        finally:
-            if connection:
-                connection.close()
     
     def save_token(self, api_key_id: int, token: str) -> bool:
         """Save token for API key"""
-        connection = None
         try:
-            connection = self.get_connection()
-            cursor = connection.cursor()
-            
-            query = "UPDATE api_keys SET code = %s WHERE id = %s"
-            cursor.execute(query, (token, api_key_id))
+            with self._cursor() as (_, cursor):
+                query = "UPDATE api_keys SET code = %s WHERE id = %s"
+                cursor.execute(query, (token, api_key_id))
             
-            connection.commit()
-            cursor.close()
-            
-            logger.info(f"Saved token for API key ID: {api_key_id}")
+            logger.info("Saved token for API key ID: %s", api_key_id)
             return True
             
         except Error as e:
             logger.error(f"Error saving token: {e}")
-            if connection:
-                connection.rollback()
             return False
-        finally:
-            if connection:
-                connection.close()
     
     def close_pool(self):
         """Close all connections in pool"""
+        self._drop_worker_connection()
+        # Dedicated connections of other threads, such as the order workers
+        with self.worker_connections_lock:
+            connections = list(self.worker_connections)
+            self.worker_connections.clear()
+        for connection in connections:
+            try:
+                connection.close()
+            except Error:
+                pass
         if self.pool:
             # Note: mysql-connector-python doesn't have a direct close_all method
             # The pool will be garbage collected when the object is destroyed
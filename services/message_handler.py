@@ -1,24 +1,50 @@
 import logging
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 from services.signal_service import SignalService
 from services.database_service import DatabaseService
 from services.template_manager import TemplateManager
 from services.alert_service import AlertService
-from utils.helpers import generate_token, format_datetime
-from config.settings import settings
+from services.affiliate_repo import CachedAffiliateRepo
+from services.registration_store import RegistrationStore
+from utils.helpers import generate_token, format_datetime_pair
+from config.settings import settings, ORDER_BATCH_SIZE, SIGNAL_GROUP_ID
 
 logger = logging.getLogger(__name__)
 
 class MessageHandler:
     def __init__(self, signal_service: SignalService, db_service: DatabaseService, 
-                 template_manager: TemplateManager, alert_service: AlertService):
+                 template_manager: TemplateManager, alert_service: AlertService,
+                 affiliate_repo: CachedAffiliateRepo, api_key_registrations: RegistrationStore):
         self.signal_service = signal_service
         self.db_service = db_service
         self.template_manager = template_manager
         self.alert_service = alert_service
-        # State management for API key registration
-        self.api_key_registration_state = {}  # {sender: state}
-        self.api_key_temp_data = {}  # {sender: {key_id, key}}
+        # Settings read while handling every message
+        self.admin_phone_number = settings.ADMIN_PHONE_NUMBER
+        self.affiliate_link = settings.AFFILIATE_LINK
+        self.token_length = settings.TOKEN_LENGTH
+        # Affiliates rarely change, keep phone lookups out of the database
+        self.affiliate_repo = affiliate_repo
+        # State management for API key registration: {sender: {state, key_id}}
+        self.api_key_registrations = api_key_registrations
+        # Commands matched case-insensitively against the whole message body
+        self.commands = {  # {casefolded body: (handler, admin only)}
+            'go': (self._handle_affiliate_registration, False),
+            'new api key': (self._handle_api_key_registration_start, True),
+        }
+        self.max_command_length = max(map(len, self.commands))
+        # Workers claiming and notifying further order batches while a backlog drains
+        self.order_concurrency = max(1, settings.ORDER_CONCURRENCY)
+        self.order_executor = ThreadPoolExecutor(
+            max_workers=max(1, self.order_concurrency - 1), thread_name_prefix='order-worker'
+        )
+        # Failed orders whose release did not reach the database, retried every cycle
+        self.unreleased_order_ids = []
+    
+    def close(self):
+        """Wait for in-flight order batches and stop the order workers"""
+        self.order_executor.shutdown(wait=True)
     
     def process_received_messages(self, messages: List[Dict]):
         """Process received Signal messages"""
@@ -31,76 +57,85 @@ class MessageHandler:
     
     def _process_single_message(self, message: Dict):
         """Process a single received message"""
-        envelope = message.get('envelope', {})
-        data_message = envelope.get('dataMessage', {})
-        
-        if not data_message:
+        # Receipts, typing indicators and sync messages have no dataMessage; drop them
+        # before any other work
+        try:
+            envelope = message['envelope']
+            body = envelope['dataMessage']['message']
+            sender = envelope['source']
+        except (KeyError, TypeError):
             return
         
-        body = data_message.get('message', '').strip()
-        sender = envelope.get('source')
-        
         if not body or not sender:
             return
         
-        logger.info(f"Received message from {sender}: {body}")
-        
-        # Check if message is "Go" for affiliate registration
-        if body.lower() == 'go':
-            self._handle_affiliate_registration(sender)
+        body = body.strip()
+        if not body:
             return
         
-        # Check if message is "New API key" from admin
-        if body == "New API key" and sender == settings.ADMIN_PHONE_NUMBER:
-            self._handle_api_key_registration_start(sender)
-            return
+        logger.info("Received message from %s: %s", sender, body)
+        
+        # Check for "Go" (affiliate registration) or "New API key" from admin; bodies
+        # longer than any command skip the casefold
+        if len(body) <= self.max_command_length:
+            command = self.commands.get(body.casefold())
+            if command:
+                handler, admin_only = command
+                if not admin_only or sender == self.admin_phone_number:
+                    handler(sender)
+                    return
         
         # Check if sender is in API key registration flow
-        if sender in self.api_key_registration_state:
-            self._handle_api_key_registration_step(sender, body)
+        registration = self.api_key_registrations.get(sender)
+        if registration:
+            self._handle_api_key_registration_step(sender, body, registration)
             return
     
     def _handle_affiliate_registration(self, phone_number: str):
         """Handle affiliate registration process"""
         try:
             # Check if affiliate already exists
-            existing_affiliate = self.db_service.get_affiliate_by_phone(phone_number)
+            existing_affiliate = self.affiliate_repo.get_by_phone(phone_number)
             
             if existing_affiliate:
                 # Send already registered message
                 message = self.template_manager.format_message(
                     'affiliate_already_registered',
-                    link=settings.AFFILIATE_LINK,
+                    link=self.affiliate_link,
                     token=existing_affiliate.token
                 )
                 self.signal_service.send_message(phone_number, message)
-                logger.info(f"Sent existing affiliate info to {phone_number}")
+                logger.info("Sent existing affiliate info to %s", phone_number)
                 return
             
             # Create new affiliate
-            token = generate_token(settings.TOKEN_LENGTH)
+            token = generate_token(self.token_length)
             affiliate_id = self.db_service.create_affiliate(phone_number, token)
+            self.affiliate_repo.invalidate(phone_number)
             
             if affiliate_id:
-                # Send registration success message
+                # Registration success message
                 message = self.template_manager.format_message(
                     'affiliate_registration_success',
-                    link=settings.AFFILIATE_LINK,
+                    link=self.affiliate_link,
                     token=token
                 )
-                self.signal_service.send_message(phone_number, message)
                 
                 # Notify owner about new affiliate
+                time_str, date_str = format_datetime_pair()
                 owner_message = self.template_manager.format_message(
                     'new_affiliate_owner',
-                    time=format_datetime('time'),
-                    date=format_datetime('date'),
+                    time=time_str,
+                    date=date_str,
                     phone=phone_number,
                     token=token
                 )
-                self.signal_service.send_message(settings.SIGNAL_GROUP_ID, owner_message, is_group=True)
+                self.signal_service.send_batch([
+                    (phone_number, message, False),
+                    (SIGNAL_GROUP_ID, owner_message, True)
+                ])
                 
-                logger.info(f"Successfully registered new affiliate: {phone_number}")
+                logger.info("Successfully registered new affiliate: %s", phone_number)
             else:
                 logger.error(f"Failed to create affiliate: {phone_number}")
                 
@@ -108,55 +143,155 @@ class MessageHandler:
             logger.error(f"Error in affiliate registration: {e}")
             self.alert_service.alert_critical_error(f"Affiliate registration error: {e}")
     
-    def process_new_orders(self):
-        """Process new orders from database"""
+    def process_new_orders(self) -> int:
+        """Process new orders from database, returning how many were notified"""
         try:
-            orders = self.db_service.get_unnotified_orders()
+            # Hand back orders a previous cycle could not release before claiming new ones
+            if self.unreleased_order_ids:
+                self._release_orders([])
+            
+            orders = self.db_service.claim_orders_for_notification(ORDER_BATCH_SIZE)
+            if not orders:
+                return 0
+            
+            # A full batch means a backlog: let the workers claim and notify further
+            # batches alongside this one, SKIP LOCKED keeps their claims disjoint
+            workers = []
+            if len(orders) == ORDER_BATCH_SIZE:
+                workers = [
+                    self.order_executor.submit(self._claim_and_notify_orders)
+                    for _ in range(self.order_concurrency - 1)
+                ]
             
-            for order in orders:
-                self._process_single_order(order)
+            failed_ids = []
+            try:
+                notified, batch_failed_ids = self._notify_orders(orders)
+                failed_ids.extend(batch_failed_ids)
+                for worker in workers:
+                    worker_notified, worker_failed_ids = worker.result()
+                    notified += worker_notified
+                    failed_ids.extend(worker_failed_ids)
+            finally:
+                # Orders are claimed as notified up front; hand failed ones back for a
+                # retry in a single write once every batch is done, even when cut short
+                self._release_orders(failed_ids)
+            return notified
                 
         except Exception as e:
             logger.error(f"Error processing orders: {e}")
             self.alert_service.alert_database_error(f"Order processing error: {e}")
+            return 0
     
-    def _process_single_order(self, order):
-        """Process a single order"""
+    def _release_orders(self, order_ids: List[int]):
+        """Release failed orders along with any left over from earlier cycles, keeping
+        them for the next cycle when the write fails"""
+        order_ids = self.unreleased_order_ids + order_ids
+        if self.db_service.release_orders(order_ids):
+            self.unreleased_order_ids = []
+            return
+        
+        # Claimed orders are flagged as notified, unless released they are never retried
+        self.unreleased_order_ids = order_ids
+        logger.error(f"Failed to release {len(order_ids)} order(s), retrying next cycle")
+        self.alert_service.alert_database_error(
+            f"Failed to release {len(order_ids)} order(s) for another notification attempt"
+        )
+    
+    def _claim_and_notify_orders(self) -> Tuple[int, List[int]]:
+        """Claim and notify one more batch of orders, from an order worker"""
         try:
-            # Format order data for messages
-            order_data = {
-                'time': format_datetime('time', order.created_at),
-                'date': format_datetime('date', order.created_at),
-                'total': f"{order.total:.2f}€" if order.total else "N/A",
-                'client': order.client or "N/A",
-                'ip': order.ip_address or "N/A"
-            }
-            
-            # Always notify owner
-            owner_message = self.template_manager.format_message('new_order_owner', **order_data)
-            self.signal_service.send_message(settings.SIGNAL_GROUP_ID, owner_message, is_group=True)
-            
-            # If order has affiliate token, notify affiliate
-            if order.affiliate_token:
-                affiliate = self.db_service.get_affiliate_by_token(order.affiliate_token)
-                if affiliate:
-                    affiliate_message = self.template_manager.format_message('new_order_affiliate', **order_data)
-                    self.signal_service.send_message(affiliate.phone_number, affiliate_message)
-                    logger.info(f"Notified affiliate {affiliate.phone_number} about order {order.id}")
-            
-            # Mark order as notified
-            self.db_service.mark_order_as_notified(order.id)
-            logger.info(f"Processed order {order.id}")
-            
+            orders = self.db_service.claim_orders_for_notification(ORDER_BATCH_SIZE)
+            return self._notify_orders(orders) if orders else (0, [])
         except Exception as e:
-            logger.error(f"Error processing order {order.id}: {e}")
-            self.alert_service.alert_critical_error(f"Order {order.id} processing error: {e}")
+            logger.error(f"Error processing orders: {e}")
+            self.alert_service.alert_database_error(f"Order processing error: {e}")
+            return 0, []
+    
+    def _notify_orders(self, orders) -> Tuple[int, List[int]]:
+        """Send the notifications of a claimed batch, returning how many orders were
+        notified and the ids of those to retry"""
+        try:
+            return self._send_order_notifications(orders)
+        except Exception as e:
+            # Nothing is known to be delivered, hand the whole batch back
+            logger.error(f"Error processing orders: {e}")
+            self.alert_service.alert_critical_error(f"Order processing error: {e}")
+            return 0, [order.id for order, _ in orders]
+    
+    def _send_order_notifications(self, orders) -> Tuple[int, List[int]]:
+        """Build and send the notifications of every order, one batch for the owner
+        and one for the affiliates"""
+        # Resolve the order templates once for the whole batch
+        owner_formatter = self.template_manager.get_formatter('new_order_owner')
+        affiliate_formatter = self.template_manager.get_formatter('new_order_affiliate')
+        
+        # Collect the notifications of every order
+        owner_sends = []  # [(recipient, message, is_group)]
+        queued = []  # [(order, affiliate, affiliate notification or None)]
+        failed_ids = []
+        for order, affiliate in orders:
+            try:
+                owner_notification, affiliate_notification = self._build_order_notifications(
+                    order, affiliate, owner_formatter, affiliate_formatter
+                )
+            except Exception as e:
+                logger.error(f"Error processing order {order.id}: {e}")
+                self.alert_service.alert_critical_error(f"Order {order.id} processing error: {e}")
+                failed_ids.append(order.id)
+                continue
+            queued.append((order, affiliate, affiliate_notification))
+            owner_sends.append(owner_notification)
+        
+        owner_sent = self.signal_service.send_batch(owner_sends) if owner_sends else []
+        
+        # Only a failed owner notification gets the order retried, so affiliates are
+        # only notified once it went out and never get the same order twice
+        affiliate_sends = []  # [(recipient, message, is_group)]
+        affiliate_orders = []  # [(order, affiliate)]
+        for (order, affiliate, affiliate_notification), sent in zip(queued, owner_sent):
+            if not sent:
+                logger.error(f"Failed to notify owner about order {order.id}")
+                failed_ids.append(order.id)
+                continue
+            
+            logger.info("Processed order %s", order.id)
+            if affiliate_notification:
+                affiliate_sends.append(affiliate_notification)
+                affiliate_orders.append((order, affiliate))
+        
+        affiliate_sent = self.signal_service.send_batch(affiliate_sends) if affiliate_sends else []
+        
+        for (order, affiliate), sent in zip(affiliate_orders, affiliate_sent):
+            if sent:
+                logger.info("Notified affiliate %s about order %s", affiliate.phone_number, order.id)
+            else:
+                logger.error(f"Failed to notify affiliate {affiliate.phone_number} about order {order.id}")
+        
+        return len(orders) - len(failed_ids), failed_ids
+    
+    def _build_order_notifications(self, order, affiliate, owner_formatter, affiliate_formatter
+                                   ) -> Tuple[Tuple[str, str, bool], Optional[Tuple[str, str, bool]]]:
+        """Build the sends for a single order: the owner's and the active affiliate's, if any"""
+        # Format order data for messages
+        time_str, date_str = format_datetime_pair(order.created_at)
+        order_data = {
+            'time': time_str,
+            'date': date_str,
+            'total': f"{order.total:.2f}€" if order.total else "N/A",
+            'client': order.client or "N/A",
+            'ip': order.ip_address or "N/A"
+        }
+        
+        owner_notification = (SIGNAL_GROUP_ID, owner_formatter(order_data), True)
+        if not affiliate:
+            return owner_notification, None
+        return owner_notification, (affiliate.phone_number, affiliate_formatter(order_data), False)
     
     def _handle_api_key_registration_start(self, sender: str):
         """Start API key registration flow"""
         try:
             # Set state to waiting for API key
-            self.api_key_registration_state[sender] = "waiting_for_api_key"
+            self.api_key_registrations.update(sender, state="waiting_for_api_key")
             
             # Send request for API key
             message = "Okay, you want to register a new API key. Please enter the new key."
@@ -168,22 +303,21 @@ class MessageHandler:
             logger.error(f"Error starting API key registration: {e}")
             self.alert_service.alert_critical_error(f"API key registration start error: {e}")
     
-    def _handle_api_key_registration_step(self, sender: str, message: str):
+    def _handle_api_key_registration_step(self, sender: str, message: str, registration: Dict[str, str]):
         """Handle steps in API key registration flow"""
         try:
-            state = self.api_key_registration_state.get(sender)
+            state = registration.get('state')
             
             if state == "waiting_for_api_key":
                 self._handle_api_key_input(sender, message)
             elif state == "waiting_for_merchant_code":
-                self._handle_merchant_code_input(sender, message)
+                self._handle_merchant_code_input(sender, message, registration)
                 
         except Exception as e:
             logger.error(f"Error in API key registration step: {e}")
             self.alert_service.alert_critical_error(f"API key registration step error: {e}")
             # Clear state on error
-            self.api_key_registration_state.pop(sender, None)
-            self.api_key_temp_data.pop(sender, None)
+            self.api_key_registrations.clear(sender)
     
     def _handle_api_key_input(self, sender: str, api_key: str):
         """Handle API key input and save to database"""
@@ -196,17 +330,11 @@ class MessageHandler:
                 error_message = "Error saving API key to database. Please try again."
                 self.signal_service.send_message(sender, error_message)
                 # Clear state
-                self.api_key_registration_state.pop(sender, None)
+                self.api_key_registrations.clear(sender)
                 return
             
-            # Store temporary data
-            self.api_key_temp_data[sender] = {
-                'key_id': key_id,
-                'key': api_key
-            }
-            
-            # Update state to waiting for merchant code
-            self.api_key_registration_state[sender] = "waiting_for_merchant_code"
+            # Update state to waiting for merchant code, keeping the key id for the next step
+            self.api_key_registrations.update(sender, state="waiting_for_merchant_code", key_id=key_id)
             
             # Request merchant code
             message = "Key saved, please now enter merchant code."
@@ -218,23 +346,21 @@ class MessageHandler:
             logger.error(f"Error handling API key input: {e}")
             self.alert_service.alert_critical_error(f"API key input error: {e}")
             # Clear state on error
-            self.api_key_registration_state.pop(sender, None)
-            self.api_key_temp_data.pop(sender, None)
+            self.api_key_registrations.clear(sender)
     
-    def _handle_merchant_code_input(self, sender: str, merchant_code: str):
+    def _handle_merchant_code_input(self, sender: str, merchant_code: str, registration: Dict[str, str]):
         """Handle merchant code input, generate token, and save to database"""
         try:
-            # Get temporary data
-            temp_data = self.api_key_temp_data.get(sender)
-            if not temp_data:
+            # Key id saved by the previous step
+            if not registration.get('key_id'):
                 # This shouldn't happen, but just in case
                 error_message = "Registration session expired. Please start over."
                 self.signal_service.send_message(sender, error_message)
                 # Clear state
-                self.api_key_registration_state.pop(sender, None)
+                self.api_key_registrations.clear(sender)
                 return
             
-            key_id = temp_data['key_id']
+            key_id = int(registration['key_id'])
             
             # Save merchant code to database
             success = self.db_service.save_merchant_code(key_id, merchant_code)
@@ -244,12 +370,11 @@ class MessageHandler:
                 error_message = "Error saving merchant code to database. Please try again."
                 self.signal_service.send_message(sender, error_message)
                 # Clear state
-                self.api_key_registration_state.pop(sender, None)
-                self.api_key_temp_data.pop(sender, None)
+                self.api_key_registrations.clear(sender)
                 return
             
             # Generate token
-            token = generate_token(settings.TOKEN_LENGTH)
+            token = generate_token(self.token_length)
             
             # Save token to database
             success = self.db_service.save_token(key_id, token)
@@ -259,8 +384,7 @@ class MessageHandler:
                 error_message = "Error saving token to database. Please try again."
                 self.signal_service.send_message(sender, error_message)
                 # Clear state
-                self.api_key_registration_state.pop(sender, None)
-                self.api_key_temp_data.pop(sender, None)
+                self.api_key_registrations.clear(sender)
                 return
             
             # Send confirmation message
@@ -268,8 +392,7 @@ class MessageHandler:
             self.signal_service.send_message(sender, confirmation_message)
             
             # Clear state
-            self.api_key_registration_state.pop(sender, None)
-            self.api_key_temp_data.pop(sender, None)
+            self.api_key_registrations.clear(sender)
             
             logger.info(f"API key registration completed for admin {sender}")
             
@@ -277,5 +400,4 @@ class MessageHandler:
             logger.error(f"Error handling merchant code input: {e}")
             self.alert_service.alert_critical_error(f"Merchant code input error: {e}")
             # Clear state on error
-            self.api_key_registration_state.pop(sender, None)
-            self.api_key_temp_data.pop(sender, None)
+            self.api_key_registrations.clear(sender)
@@ -0,0 +1,76 @@
+import logging
+from typing import Dict, Optional
+from cachetools import TTLCache
+from config.settings import settings
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+class RegistrationStore:
+    """In-flight API key registration flows, one {field: value} hash per sender that
+    expires when abandoned. Kept in Redis when a client is given, so flows survive a
+    restart, in process otherwise or while Redis is unavailable."""
+    
+    def __init__(self, redis_client: Optional['redis.Redis'] = None):
+        self.ttl = settings.REGISTRATION_TTL
+        self.redis = redis_client
+        # Flows that could not be written to Redis are kept here instead
+        self.local_store = TTLCache(maxsize=1024, ttl=self.ttl)  # {sender: {field: value}}
+    
+    def get(self, sender: str) -> Optional[Dict[str, str]]:
+        """Get the registration of sender, None when there is none in flight"""
+        # A flow only stays in process while Redis is unavailable, so it is the most recent
+        registration = self.local_store.get(sender)
+        if registration is not None or self.redis is None:
+            return registration
+        
+        # Looked up for every inbound message, when Redis is unavailable act as if no flow is in flight
+        try:
+            registration = self.redis.hgetall(self._key(sender))
+        except redis.RedisError as e:
+            logger.warning(f"Failed to load API key registration of {sender}: {e}")
+            return None
+        if not registration:
+            return None
+        return {field.decode(): value.decode() for field, value in registration.items()}
+    
+    def update(self, sender: str, **fields):
+        """Set fields of the registration of sender, restarting its expiry"""
+        if self.redis is not None:
+            # Carry over what was kept in process while Redis was unavailable
+            fields = {**self.local_store.get(sender, {}), **fields}
+            key = self._key(sender)
+            pipeline = self.redis.pipeline()
+            pipeline.hset(key, mapping=fields)
+            pipeline.expire(key, self.ttl)
+            try:
+                pipeline.execute()
+                self.local_store.pop(sender, None)
+                return
+            except redis.RedisError as e:
+                logger.warning(f"Failed to save API key registration of {sender}, keeping it in process: {e}")
+        
+        registration = self.local_store.get(sender, {})
+        registration.update({field: str(value) for field, value in fields.items()})
+        # Re-inserting restarts the TTL
+        self.local_store[sender] = registration
+    
+    def clear(self, sender: str):
+        """End the registration of sender"""
+        self.local_store.pop(sender, None)
+        if self.redis is None:
+            return
+        
+        try:
+            self.redis.delete(self._key(sender))
+        except redis.RedisError as e:
+            logger.warning(f"Failed to clear API key registration of {sender}: {e}")
+    
+    @staticmethod
+    def _key(sender: str) -> str:
+        """Redis key holding the registration of sender"""
+        return f"apikeyreg:{sender}"
@@ -1,101 +1,343 @@
 import subprocess
-import json
+import orjson
 import logging
+import queue
+import socket
+import itertools
+import threading
 import time
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 from config.settings import settings
 
 logger = logging.getLogger(__name__)
 
+# Read buffer of the JSON-RPC stream; a batch of responses or a burst of incoming
+# messages arrives as long lines, large reads keep the reader to few syscalls
+STREAM_BUFFER_SIZE = 65536
+
 class SignalService:
     def __init__(self):
         self.signal_number = settings.SIGNAL_NUMBER
+        self.admin_phone_number = settings.ADMIN_PHONE_NUMBER
         self.max_retries = settings.MAX_RETRIES
+        self.socket_path = settings.SIGNAL_CLI_SOCKET
+        # Long-lived JSON-RPC stream: either a connection to an external
+        # `signal-cli daemon --socket` or a signal-cli jsonRpc child process
+        self.connection = None
+        self.process = None
+        # Readable side of whichever stream is open, replaced on every (re)connect
+        self.stream = None
+        self._reader = None
+        self._closed = False
+        # Incoming messages queued by the reader thread; None entries only wake a waiting consumer.
+        # SimpleQueue.put is reentrant, so wake() is safe to call from a signal handler
+        self.inbox = queue.SimpleQueue()
+        self._pending = set()
+        self._responses = {}
+        self._request_ids = itertools.count(1)
+        # _stream_lock serializes opening and closing the stream; _lock guards the
+        # request state shared with the reader thread and is never held while joining it
+        # or writing to the stream; _write_lock keeps concurrent requests from interleaving
+        self._stream_lock = threading.Lock()
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._response_ready = threading.Condition(self._lock)
+    
+    def start_receiving(self):
+        """Open the JSON-RPC stream, over which incoming messages are streamed and sends are made"""
+        with self._stream_lock:
+            if self.is_receiving():
+                return
+            # Release whatever is left of a stream that closed on its own
+            self._close_stream()
+            
+            if self.socket_path:
+                self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    self.connection.connect(self.socket_path)
+                except OSError:
+                    self.connection.close()
+                    self.connection = None
+                    raise
+                self.stream = self.connection.makefile('rb', buffering=STREAM_BUFFER_SIZE)
+                source = f"signal-cli daemon at {self.socket_path}"
+            else:
+                cmd = ['signal-cli', '-a', self.signal_number, 'jsonRpc']
+                self.process = subprocess.Popen(
+                    cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=STREAM_BUFFER_SIZE
+                )
+                self.stream = self.process.stdout
+                source = "signal-cli JSON-RPC process"
+            
+            with self._lock:
+                self._closed = False
+            self._reader = threading.Thread(
+                target=self._read_stream, args=(self.stream,), name='signal-reader', daemon=True
+            )
+            self._reader.start()
+            
+            logger.info(f"Connected to {source}")
+    
+    def stop_receiving(self):
+        """Close the JSON-RPC stream, stopping the signal-cli process if we own it"""
+        with self._stream_lock:
+            self._close_stream()
+    
+    def _close_stream(self):
+        """Close the current stream and wait for its reader thread; needs _stream_lock"""
+        with self._lock:
+            connection, self.connection = self.connection, None
+            process, self.process = self.process, None
+            stream, self.stream = self.stream, None
+            reader, self._reader = self._reader, None
+            if not connection and not process:
+                return
+            
+            self._pending.clear()
+            self._responses.clear()
+            self._response_ready.notify_all()
+        
+        # Outside the lock: the reader thread takes it on its way out
+        if connection:
+            try:
+                # Unblocks the reader thread, closing alone does not interrupt a pending read
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        
+        if process:
+            try:
+                # Terminate first, a writer blocked on a full stdin pipe holds it until signal-cli is gone
+                process.terminate()
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            except Exception as e:
+                logger.warning(f"Error stopping signal-cli JSON-RPC process: {e}")
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+        
+        reader.join(timeout=10)
+        stream.close()
+        if connection:
+            connection.close()
+        
+        logger.info("Closed signal-cli JSON-RPC stream")
+    
+    def is_receiving(self) -> bool:
+        """Check whether the JSON-RPC stream is open"""
+        if self.stream is None or self._closed:
+            return False
+        return self.process is None or self.process.poll() is None
+    
+    def wake(self):
+        """Wake up a consumer blocked in receive_messages"""
+        self.inbox.put(None)
+    
+    def _write(self, connection: Optional[socket.socket], process: Optional[subprocess.Popen], data: bytes):
+        """Write raw data to the outgoing side of a JSON-RPC stream; needs _write_lock"""
+        if connection is not None:
+            connection.sendall(data)
+        else:
+            process.stdin.write(data)
+            process.stdin.flush()
+    
+    def _read_stream(self, stream):
+        """Reader thread: dispatch every line signal-cli writes until the stream closes"""
+        try:
+            for line in stream:
+                self._dispatch_line(line)
+        except (OSError, ValueError):
+            # The stream was closed under us by stop_receiving
+            pass
+        finally:
+            with self._lock:
+                if self.stream is stream:
+                    logger.error("signal-cli JSON-RPC stream closed unexpectedly")
+                    self._closed = True
+                self._response_ready.notify_all()
+            # Let the consumer notice the closed stream and reopen it
+            self.wake()
+    
+    def _dispatch_line(self, line: bytes):
+        """Route one JSON-RPC line to the inbox (notifications) or to a waiting request (responses)"""
+        if not line.strip():
+            return
+        
+        try:
+            data = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            logger.warning(f"Failed to parse JSON-RPC line: {line!r}")
+            return
+        
+        # A batch request is answered with an array of responses on a single line
+        for item in data if isinstance(data, list) else [data]:
+            if item.get('method') == 'receive':
+                self.inbox.put(item.get('params', {}))
+                continue
+            
+            with self._lock:
+                if item.get('id') in self._pending:
+                    self._responses[item['id']] = item
+                    self._response_ready.notify_all()
+    
+    def _request(self, method: str, params: Dict, timeout: float = 30) -> Dict:
+        """Send a JSON-RPC request over the stream and wait for its response"""
+        return self._request_batch([(method, params)], timeout)[0]
+    
+    def _request_batch(self, calls: List[Tuple[str, Dict]], timeout: float = 30) -> List[Dict]:
+        """Send JSON-RPC requests as a single batch over the stream, (re)opening it if needed,
+        and wait for all of their responses"""
+        if not self.is_receiving():
+            self.start_receiving()
+        
+        with self._lock:
+            if not self.is_receiving():
+                raise RuntimeError("signal-cli JSON-RPC stream closed")
+            
+            requests = [
+                {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': next(self._request_ids)}
+                for method, params in calls
+            ]
+            request_ids = [request['id'] for request in requests]
+            self._pending.update(request_ids)
+            connection, process, stream = self.connection, self.process, self.stream
+        
+        try:
+            payload = requests[0] if len(requests) == 1 else requests
+            # Written without _lock: signal-cli stops reading a large batch while its own output
+            # is full, and only the reader thread, which needs _lock to hand off responses, drains it
+            with self._write_lock:
+                self._write(connection, process, orjson.dumps(payload) + b'\n')
+            
+            with self._lock:
+                # The reader thread stores the responses and notifies us as they arrive
+                answered = self._response_ready.wait_for(
+                    lambda: all(request_id in self._responses for request_id in request_ids)
+                    or self.stream is not stream or self._closed,
+                    timeout
+                )
+                if not answered:
+                    raise subprocess.TimeoutExpired(calls[0][0], timeout)
+                if not all(request_id in self._responses for request_id in request_ids):
+                    raise RuntimeError("signal-cli JSON-RPC stream closed")
+                
+                return [self._responses.pop(request_id) for request_id in request_ids]
+        finally:
+            with self._lock:
+                self._pending.difference_update(request_ids)
+                for request_id in request_ids:
+                    self._responses.pop(request_id, None)
     
     def send_message(self, recipient: str, message: str, is_group: bool = False) -> bool:
         """Send a Signal message to recipient with retry logic"""
+        return self.send_batch([(recipient, message, is_group)])[0]
+    
+    def send_batch(self, items: List[Tuple[str, str, bool]]) -> List[bool]:
+        """Send (recipient, message, is_group) items in one JSON-RPC batch with retry logic,
+        returning whether each item was sent"""
+        results = [False] * len(items)
+        remaining = list(range(len(items)))
+        
         for attempt in range(self.max_retries):
             try:
-                cmd = [
-                    'signal-cli',
-                    '-a', self.signal_number,
-                    'send'
-                ]
-                
-                if is_group:
-                    cmd.extend(['-g', recipient])
-                else:
-                    cmd.append(recipient)
-                
-                cmd.extend(['-m', message])
-                
-                result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-                
-                if result.returncode == 0:
-                    logger.info(f"Message sent successfully to {recipient}")
-                    return True
-                else:
-                    logger.error(f"Failed to send message to {recipient}: {result.stderr}")
+                sent = self._send_batch_once([items[index] for index in remaining])
+                for index, item_sent in zip(remaining, sent):
+                    results[index] = item_sent
                     
             except subprocess.TimeoutExpired:
-                logger.error(f"Timeout sending message to {recipient} (attempt {attempt + 1})")
+                logger.error(f"Timeout sending {len(remaining)} message(s) (attempt {attempt + 1})")
             except Exception as e:
-                logger.error(f"Error sending message to {recipient} (attempt {attempt + 1}): {str(e)}")
+                logger.error(f"Error sending {len(remaining)} message(s) (attempt {attempt + 1}): {str(e)}")
+            
+            remaining = [index for index in remaining if not results[index]]
+            if not remaining:
+                break
             
             if attempt < self.max_retries - 1:
                 # Exponential backoff
                 wait_time = 2 ** attempt
-                logger.info(f"Retrying in {wait_time} seconds...")
+                logger.info("Retrying in %s seconds...", wait_time)
                 time.sleep(wait_time)
         
-        logger.error(f"All attempts failed to send message to {recipient}")
-        return False
+        for index in remaining:
+            logger.error(f"All attempts failed to send message to {items[index][0]}")
+        return results
     
-    def receive_messages(self) -> List[Dict]:
-        """Receive new Signal messages"""
-        try:
-            cmd = [
-                'signal-cli',
-                '-a', self.signal_number,
-                '--output=json',
-                'receive'
-                
-            ]
-            
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+    def _send_batch_once(self, items: List[Tuple[str, str, bool]]) -> List[bool]:
+        """Single send attempt over the JSON-RPC stream. The same message going to several
+        different people becomes one multi-recipient send, every item is still delivered once."""
+        # signal-cli holds the account lock while streaming, so sends must go through it
+        sends = []  # [(params, [item index])]
+        direct_sends = {}  # {message: [(params, [item index])]}
+        for index, (recipient, message, is_group) in enumerate(items):
+            if is_group:
+                sends.append(({'groupId': recipient, 'message': message}, [index]))
+                continue
             
-            if result.returncode != 0:
-                logger.error(f"Failed to receive messages: {result.stderr}")
-                return []
-            
-            messages = []
-            for line in result.stdout.strip().split('\n'):
-                if line.strip():
-                    try:
-                        message_data = json.loads(line)
-                        messages.append(message_data)
-                    except json.JSONDecodeError:
-                        logger.warning(f"Failed to parse message JSON: {line}")
+            # A repeated (recipient, message) item is a distinct notification, it goes into
+            # the next send of that message that does not reach this recipient yet
+            for params, indexes in direct_sends.setdefault(message, []):
+                if recipient not in params['recipient']:
+                    break
+            else:
+                params, indexes = {'recipient': [], 'message': message}, []
+                sends.append((params, indexes))
+                direct_sends[message].append((params, indexes))
+            params['recipient'].append(recipient)
+            indexes.append(index)
+        
+        responses = self._request_batch([('send', params) for params, _ in sends])
+        
+        sent = [False] * len(items)
+        for (params, indexes), response in zip(sends, responses):
+            if 'error' in response:
+                recipients = params.get('groupId') or ', '.join(params['recipient'])
+                logger.error(f"Failed to send message to {recipients}: {response['error'].get('message')}")
+                continue
             
-            return messages
+            # Direct sends report per recipient, a group send counts as sent as a whole
+            failed = set()
+            if 'recipient' in params:
+                results = (response.get('result') or {}).get('results') or []
+                failed = {
+                    (result.get('recipientAddress') or {}).get('number')
+                    for result in results if result.get('type') != 'SUCCESS'
+                }
             
-        except subprocess.TimeoutExpired:
-            logger.warning("Timeout receiving messages")
-            return []
-        except Exception as e:
-            logger.error(f"Error receiving messages: {str(e)}")
-            return []
+            for index in indexes:
+                recipient = items[index][0]
+                if recipient in failed:
+                    logger.error(f"Failed to send message to {recipient}")
+                else:
+                    logger.info("Message sent successfully to %s", recipient)
+                    sent[index] = True
+        return sent
+    
+    def receive_messages(self, timeout: float = 0) -> List[Dict]:
+        """Wait up to timeout seconds for incoming Signal messages and return every one queued"""
+        messages = []
+        try:
+            message = self.inbox.get(block=timeout > 0, timeout=timeout)
+            while True:
+                if message is not None:
+                    messages.append(message)
+                message = self.inbox.get_nowait()
+        except queue.Empty:
+            pass
+        return messages
     
     def send_alert(self, message: str) -> bool:
         """Send alert message to admin"""
-        return self.send_message(settings.ADMIN_PHONE_NUMBER, message)
+        return self.send_message(self.admin_phone_number, message)
     
     def test_signal_cli(self) -> bool:
         """Test signal-cli connectivity"""
         try:
-            cmd = ['signal-cli', '-a', self.signal_number, 'listIdentities']
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
-            return result.returncode == 0
+            return 'error' not in self._request('listIdentities', {}, timeout=10)
         except Exception as e:
             logger.error(f"Signal-CLI test failed: {e}")
             return False
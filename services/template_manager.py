@@ -1,105 +1,120 @@
 import yaml
 import logging
-from typing import Dict
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+import os
+import time
+from types import MappingProxyType
+from typing import Callable, Dict, Mapping
 from config.settings import settings
 import threading
 
 logger = logging.getLogger(__name__)
 
-class TemplateHandler(FileSystemEventHandler):
-    def __init__(self, template_manager):
-        self.template_manager = template_manager
-    
-    def on_modified(self, event):
-        if not event.is_directory and event.src_path == settings.TEMPLATES_FILE:
-            logger.info("Templates file modified, reloading...")
-            self.template_manager.reload_templates()
+# Minimum seconds between two checks of the templates file for changes
+TEMPLATE_CHECK_INTERVAL = 1.0
 
 class TemplateManager:
     def __init__(self):
-        self.templates = {}
-        self.observer = None
-        self.lock = threading.RLock()
+        # Read-only snapshots, rebuilt on every load and replaced as a whole, so
+        # readers use whichever snapshot they see without taking the lock
+        self.templates: Mapping[str, Dict] = MappingProxyType({})
+        self.formatters: Mapping[str, Callable[[Dict], str]] = MappingProxyType({})
+        # Edits are picked up by comparing the file's mtime, checked on access
+        self.mtime = None
+        self.last_check = time.monotonic()
+        # Only serializes reloads, readers never take it
+        self.lock = threading.Lock()
         self.load_templates()
-        self.start_watching()
     
     def load_templates(self):
         """Load templates from YAML file"""
         try:
+            self.mtime = os.stat(settings.TEMPLATES_FILE).st_mtime_ns
             with open(settings.TEMPLATES_FILE, 'r', encoding='utf-8') as file:
                 data = yaml.safe_load(file)
                 
             if 'templates' not in data:
                 raise ValueError("Templates file must contain 'templates' key")
             
-            with self.lock:
-                self.templates = data['templates']
+            self._publish(data['templates'])
             
             logger.info(f"Loaded {len(self.templates)} templates")
             
         except Exception as e:
             logger.error(f"Error loading templates: {e}")
             if not self.templates:  # If no templates loaded yet, use defaults
-                self.templates = self._get_default_templates()
+                self._publish(self._get_default_templates())
     
     def reload_templates(self):
         """Reload templates and validate"""
-        old_templates = self.templates.copy()
-        try:
-            self.load_templates()
-            self._log_template_update("Templates reloaded successfully")
-        except Exception as e:
-            logger.error(f"Failed to reload templates: {e}")
-            with self.lock:
-                self.templates = old_templates
-            self._log_template_update(f"Template reload failed: {e}")
+        with self.lock:
+            old_templates = self.templates.copy()
+            try:
+                self.load_templates()
+                self._log_template_update("Templates reloaded successfully")
+            except Exception as e:
+                logger.error(f"Failed to reload templates: {e}")
+                self._publish(old_templates)
+                self._log_template_update(f"Template reload failed: {e}")
     
     def get_template(self, template_key: str) -> str:
         """Get template by key"""
-        with self.lock:
-            if template_key not in self.templates:
-                logger.warning(f"Template '{template_key}' not found")
-                return "Template not found: {message}"
-            
-            return self.templates[template_key]['format']
+        template = self.templates.get(template_key)
+        if template is None:
+            logger.warning(f"Template '{template_key}' not found")
+            return "Template not found: {message}"
+        
+        return template['format']
+    
+    def get_formatter(self, template_key: str) -> Callable[[Dict], str]:
+        """Get a compiled formatter for template, called with a dict of template variables"""
+        self._check_for_changes()
+        formatter = self.formatters.get(template_key)
+        if formatter is None:
+            formatter = self._compile(self.get_template(template_key))
+        return formatter
     
     def format_message(self, template_key: str, **kwargs) -> str:
         """Format message using template"""
-        template = self.get_template(template_key)
-        try:
-            return template.format(**kwargs)
-        except KeyError as e:
-            logger.error(f"Missing template variable: {e}")
-            return f"Template error: missing variable {e}"
-        except Exception as e:
-            logger.error(f"Template formatting error: {e}")
-            return f"Template formatting error: {e}"
+        return self.get_formatter(template_key)(kwargs)
     
-    def start_watching(self):
-        """Start watching templates file for changes"""
+    def _check_for_changes(self):
+        """Reload templates if the file changed, looking at most once per check interval"""
+        now = time.monotonic()
+        if now - self.last_check < TEMPLATE_CHECK_INTERVAL:
+            return
+        self.last_check = now
+        
         try:
-            self.observer = Observer()
-            event_handler = TemplateHandler(self)
-            
-            # Watch the directory containing the templates file
-            import os
-            watch_dir = os.path.dirname(settings.TEMPLATES_FILE)
-            self.observer.schedule(event_handler, watch_dir, recursive=False)
-            self.observer.start()
-            
-            logger.info("Started watching templates file for changes")
-            
-        except Exception as e:
-            logger.error(f"Failed to start template file watcher: {e}")
+            mtime = os.stat(settings.TEMPLATES_FILE).st_mtime_ns
+        except OSError:
+            return
+        
+        if mtime != self.mtime:
+            logger.info("Templates file modified, reloading...")
+            self.mtime = mtime
+            self.reload_templates()
+    
+    def _publish(self, templates: Dict):
+        """Compile every template and swap in the new templates and formatters"""
+        formatters = {key: self._compile(template['format']) for key, template in templates.items()}
+        self.templates = MappingProxyType(templates)
+        self.formatters = MappingProxyType(formatters)
     
-    def stop_watching(self):
-        """Stop watching templates file"""
-        if self.observer:
-            self.observer.stop()
-            self.observer.join()
-            logger.info("Stopped watching templates file")
+    def _compile(self, template: str) -> Callable[[Dict], str]:
+        """Bind the template's format_map once so formatting skips the template lookup"""
+        format_map = template.format_map
+        
+        def formatter(values: Dict) -> str:
+            try:
+                return format_map(values)
+            except KeyError as e:
+                logger.error(f"Missing template variable: {e}")
+                return f"Template error: missing variable {e}"
+            except Exception as e:
+                logger.error(f"Template formatting error: {e}")
+                return f"Template formatting error: {e}"
+        
+        return formatter
     
     def _log_template_update(self, message: str):
         """Log template updates to separate file"""
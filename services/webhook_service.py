@@ -1,57 +1,83 @@
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 import logging
 import time
-from typing import Dict, Optional
+from typing import Dict
 from config.settings import settings
 
 logger = logging.getLogger(__name__)
 
+# Color code for different alert types
+ALERT_COLORS = {
+    "info": "#36a64f",      # Green
+    "warning": "#ff9500",   # Orange
+    "error": "#ff0000",     # Red
+    "critical": "#8b0000"   # Dark Red
+}
+
 class WebhookService:
+    __slots__ = ('webhook_url', 'enabled', 'timeout', 'max_retries', 'session',
+                 '_active', '_timestamp_second', '_timestamp')
+    
     def __init__(self):
         self.webhook_url = settings.WEBHOOK_URL
         self.enabled = settings.WEBHOOK_ENABLED
         self.timeout = settings.WEBHOOK_TIMEOUT
         self.max_retries = settings.WEBHOOK_RETRIES
+        # Settings do not change at runtime, decide once whether webhooks go out
+        self._active = bool(self.enabled and self.webhook_url)
+        # Keep-alive session so repeated alerts reuse the connection instead of a
+        # new TCP+TLS handshake each; urllib3 retries with exponential backoff
+        retry = Retry(
+            total=max(0, self.max_retries - 1),
+            backoff_factor=1,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset({'POST'}),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_maxsize=10, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Content-Type'] = 'application/json'
+        # Alert timestamps only have second resolution, format each second once
+        self._timestamp_second = None
+        self._timestamp = None
+    
+    def close(self):
+        """Close the pooled webhook connections"""
+        self.session.close()
     
     def send_webhook(self, message: str, alert_type: str = "info") -> bool:
-        """Send webhook notification with retry logic"""
-        if not self.enabled or not self.webhook_url:
+        """Send webhook notification. Connection errors and 429/5xx responses are retried
+        inside the session's urllib3 Retry, anything else fails on the first attempt"""
+        if not self._active:
             return False
         
         payload = self._create_payload(message, alert_type)
         
-        for attempt in range(self.max_retries):
-            try:
-                response = requests.post(
-                    self.webhook_url,
-                    json=payload,
-                    timeout=self.timeout,
-                    headers={'Content-Type': 'application/json'}
-                )
+        try:
+            response = self.session.post(self.webhook_url, data=orjson.dumps(payload), timeout=self.timeout)
+            
+            if response.status_code == 200:
+                logger.info("Webhook sent successfully: %s", message)
+                return True
+            else:
+                logger.warning(f"Webhook failed with status {response.status_code}: {response.text}")
                 
-                if response.status_code == 200:
-                    logger.info(f"Webhook sent successfully: {message}")
-                    return True
-                else:
-                    logger.warning(f"Webhook failed with status {response.status_code}: {response.text}")
-                    
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Webhook attempt {attempt + 1} failed: {e}")
-                
-                if attempt < self.max_retries - 1:
-                    # Exponential backoff
-                    wait_time = 2 ** attempt
-                    time.sleep(wait_time)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Webhook request failed: {e}")
         
-        logger.error(f"All webhook attempts failed for message: {message}")
+        logger.error(f"Webhook not delivered for message: {message}")
         return False
     
     def _create_payload(self, message: str, alert_type: str) -> Dict:
         """Create webhook payload - supports Slack/Discord format"""
         # Generic webhook payload that works with most services
         payload = {
-            "text": f"🤖 Signal Automation Alert",
+            "text": "🤖 Signal Automation Alert",
             "attachments": [
                 {
                     "color": self._get_color_for_type(alert_type),
@@ -68,7 +94,7 @@ class WebhookService:
                         },
                         {
                             "title": "Timestamp",
-                            "value": time.strftime("%Y-%m-%d %H:%M:%S UTC"),
+                            "value": self._get_timestamp(),
                             "short": True
                         }
                     ]
@@ -80,13 +106,15 @@ class WebhookService:
     
     def _get_color_for_type(self, alert_type: str) -> str:
         """Get color code for different alert types"""
-        colors = {
-            "info": "#36a64f",      # Green
-            "warning": "#ff9500",   # Orange
-            "error": "#ff0000",     # Red
-            "critical": "#8b0000"   # Dark Red
-        }
-        return colors.get(alert_type.lower(), "#36a64f")
+        return ALERT_COLORS.get(alert_type.lower(), ALERT_COLORS["info"])
+    
+    def _get_timestamp(self) -> str:
+        """Current UTC timestamp, reformatted at most once per second"""
+        now = int(time.time())
+        if now != self._timestamp_second:
+            self._timestamp = time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(now))
+            self._timestamp_second = now
+        return self._timestamp
     
     def test_webhook(self) -> bool:
         """Test webhook connectivity"""
@@ -1,37 +1,68 @@
-import random
+import os
 import string
-import pytz
-from datetime import datetime
-from typing import Optional
+import logging
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+from zoneinfo import ZoneInfo
 from config.settings import settings
 
+logger = logging.getLogger(__name__)
+
+# Resolved once; naive datetimes are treated as UTC
+LOCAL_TZ = ZoneInfo(settings.TIMEZONE)
+
+_ALPHABET = string.ascii_uppercase + string.digits
+
+# Random bytes map to token characters with bytes.translate; bytes from 252 up (the
+# largest multiple of 36 in a byte) are dropped so every character stays equally likely
+_TOKEN_TABLE = bytes(_ALPHABET.encode()[b % len(_ALPHABET)] for b in range(256))
+_REJECTED_BYTES = bytes(range(256 - 256 % len(_ALPHABET), 256))
+
+_FMT = {
+    'time': "%H:%M:%S",
+    'date': "%Y-%m-%d",
+}
+
 def generate_token(length: int = 12) -> str:
     """Generate random alphanumeric token"""
-    characters = string.ascii_uppercase + string.digits
-    return ''.join(random.choice(characters) for _ in range(length))
+    # Tokens authenticate affiliates and API clients, draw them from the OS CSPRNG
+    chars = b''
+    while len(chars) < length:
+        # About 1.6% of the bytes get rejected, draw a little extra up front
+        raw = os.urandom((length - len(chars)) * 17 // 16 + 8)
+        chars += raw.translate(_TOKEN_TABLE, _REJECTED_BYTES)
+    
+    return chars[:length].decode('ascii')
 
-def format_datetime(format_type: str, dt: Optional[datetime] = None) -> str:
-    """Format datetime for Paris timezone"""
+def _to_local(dt: Optional[datetime]) -> datetime:
+    """Convert datetime (naive UTC or aware, now if None) to the configured timezone"""
     if dt is None:
-        dt = datetime.utcnow()
-    
-    # Convert to Paris timezone
-    utc = pytz.UTC
-    paris_tz = pytz.timezone(settings.TIMEZONE)
+        return datetime.now(LOCAL_TZ)
     
     if dt.tzinfo is None:
-        dt = utc.localize(dt)
+        dt = dt.replace(tzinfo=timezone.utc)
     
-    paris_dt = dt.astimezone(paris_tz)
+    return dt.astimezone(LOCAL_TZ)
+
+def format_datetime_pair(dt: Optional[datetime] = None) -> Tuple[str, str]:
+    """Format datetime as (time, date) in the configured timezone with a single conversion"""
+    local_dt = _to_local(dt)
+    return local_dt.strftime(_FMT['time']), local_dt.strftime(_FMT['date'])
+
+def create_redis_client():
+    """Create the shared Redis client for REDIS_URL, or None to use in-process fallbacks"""
+    if not settings.REDIS_URL:
+        return None
     
-    if format_type == 'time':
-        return paris_dt.strftime("%H:%M:%S")
-    elif format_type == 'date':
-        return paris_dt.strftime("%Y-%m-%d")
-    elif format_type == 'datetime':
-        return paris_dt.strftime("%Y-%m-%d %H:%M:%S")
-    else:
-        return paris_dt.strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        import redis
+    except ImportError:
+        logger.warning("REDIS_URL is set but the redis package is not installed, "
+                       "using in-process caches")
+        return None
+    
+    logger.info("Using Redis for affiliate cache and registration state")
+    return redis.Redis(connection_pool=redis.ConnectionPool.from_url(settings.REDIS_URL))
 
 def setup_logging():
     """Setup logging configuration"""
@@ -52,40 +83,32 @@ def setup_logging():
         datefmt='%Y-%m-%d %H:%M:%S'
     )
     
+    def _make_handler(filename: str) -> logging.Handler:
+        """Log file handler with daily rotation, the file is only opened on first write"""
+        handler = logging.handlers.TimedRotatingFileHandler(
+            filename=os.path.join(settings.LOG_DIR, filename),
+            when='midnight',
+            interval=1,
+            backupCount=7,  # Keep 1 week of logs
+            encoding='utf-8',
+            delay=True
+        )
+        handler.setFormatter(formatter)
+        return handler
+    
     # Main log file handler with rotation
-    main_handler = logging.handlers.TimedRotatingFileHandler(
-        filename=os.path.join(settings.LOG_DIR, 'signal-automation.log'),
-        when='midnight',
-        interval=1,
-        backupCount=7,  # Keep 1 week of logs
-        encoding='utf-8'
-    )
-    main_handler.setFormatter(formatter)
-    main_logger.addHandler(main_handler)
+    main_logger.addHandler(_make_handler('signal-automation.log'))
     
-    # Critical errors log
+    # Critical errors also propagate to the main log and the console, some of them
+    # (failed alerts) are reported nowhere else
     critical_logger = logging.getLogger('critical')
-    critical_handler = logging.handlers.TimedRotatingFileHandler(
-        filename=os.path.join(settings.LOG_DIR, 'critical-errors.log'),
-        when='midnight',
-        interval=1,
-        backupCount=7,
-        encoding='utf-8'
-    )
-    critical_handler.setFormatter(formatter)
-    critical_logger.addHandler(critical_handler)
+    critical_logger.addHandler(_make_handler('critical-errors.log'))
     
-    # Template updates log
+    # Template updates get their own file only, TemplateManager already reports
+    # reloads and their failures through its module logger
     template_logger = logging.getLogger('templates')
-    template_handler = logging.handlers.TimedRotatingFileHandler(
-        filename=os.path.join(settings.LOG_DIR, 'template-updates.log'),
-        when='midnight',
-        interval=1,
-        backupCount=7,
-        encoding='utf-8'
-    )
-    template_handler.setFormatter(formatter)
-    template_logger.addHandler(template_handler)
+    template_logger.addHandler(_make_handler('template-updates.log'))
+    template_logger.propagate = False
     
     # Console handler for debugging (optional)
     console_handler = logging.StreamHandler()